@@ -5,14 +5,19 @@ Kibana MCP Server
 """
 
 import asyncio
-import json
+import functools
+import logging
 import os
+import random
 import sys
-from datetime import datetime, timedelta
-from typing import Any, Optional
+import time
+from datetime import timedelta
+from pathlib import Path
+from typing import Any, Optional, Union
 from urllib.parse import quote
 
 import httpx
+import orjson
 from mcp.server import Server
 from mcp.types import (
     Resource,
@@ -24,12 +29,48 @@ from mcp.types import (
 from pydantic import BaseModel, Field
 
 
+logger = logging.getLogger(__name__)
+
 # 配置
 KIBANA_URL = os.getenv("KIBANA_URL", "https://logs.example.com")
 KIBANA_VERSION = os.getenv("KIBANA_VERSION", "8.17.1")
 KIBANA_USERNAME = os.getenv("KIBANA_USERNAME")
 KIBANA_PASSWORD = os.getenv("KIBANA_PASSWORD")
 SESSION_TIMEOUT = timedelta(hours=23)  # sid cookie 通常 24 小时过期
+SESSION_CACHE_FILE = Path.home() / ".cache" / "kibana-mcp" / "session.json"  # 跨进程复用 sid cookie
+
+BATCH_MAX_QUERIES = 20  # kibana_batch_search 单次调用的查询数量上限
+
+# 重试配置（指数退避 + 随机抖动）
+MAX_RETRIES = 4
+RETRY_BASE_DELAY = 0.25  # 秒
+RETRY_MAX_DELAY = 8.0  # 秒
+RETRYABLE_STATUS_CODES = frozenset({502, 503, 504})
+# 可安全重试的瞬时网络错误（RemoteProtocolError 常见于 HTTP/2 连接被服务端 GOAWAY 关闭）
+RETRYABLE_EXCEPTIONS = (
+    httpx.ConnectError,
+    httpx.ConnectTimeout,
+    httpx.ReadTimeout,
+    httpx.RemoteProtocolError,
+)
+
+# 让 Elasticsearch 只返回格式化输出需要的字段，避免传输和解析整份响应
+_HITS_FILTER_PATH = "filter_path=hits.total,hits.hits._source"
+_AGGS_FILTER_PATH = "filter_path=aggregations"
+
+# 只读的空 dict 默认值，避免在逐条日志循环中反复创建 {}
+_EMPTY: dict = {}
+
+
+@functools.lru_cache(maxsize=64)
+def _build_proxy_url(path: str) -> str:
+    """构建 Kibana console proxy URL（按 path 缓存，避免重复编码）"""
+    return f"{KIBANA_URL}/api/console/proxy?path={quote(path, safe='')}&method=POST"
+
+
+def _backoff_delay(attempt: int) -> float:
+    """计算第 attempt 次重试前的等待时间（秒）"""
+    return min(RETRY_BASE_DELAY * (2 ** attempt), RETRY_MAX_DELAY) + random.uniform(0, RETRY_BASE_DELAY)
 
 
 class KibanaSession:
@@ -39,113 +80,202 @@ class KibanaSession:
         self.username = username
         self.password = password
         self.sid_cookie: Optional[str] = None
-        self.session_created_at: Optional[datetime] = None
-        self.client = httpx.AsyncClient(timeout=30.0)
+        self.session_expires_at: float = 0.0  # time.monotonic() 时间戳
+        # 串行化登录，避免并发请求在会话过期时同时重新登录
+        self._login_lock = asyncio.Lock()
+        # 登录 URL 和请求体在会话生命周期内不变，预先构建并序列化
+        self._login_url = f"{KIBANA_URL}/internal/security/login"
+        self._login_body = orjson.dumps({
+            "providerType": "basic",
+            "providerName": "cloud-basic",
+            "currentURL": f"{KIBANA_URL}/login?msg=LOGGED_OUT",
+            "params": {
+                "username": username,
+                "password": password
+            }
+        })
+        # 复用连接：启用 HTTP/2 多路复用并放宽 keep-alive 连接池，避免重复 TLS 握手
+        self.client = httpx.AsyncClient(
+            timeout=30.0,
+            http2=True,
+            limits=httpx.Limits(
+                max_keepalive_connections=20,
+                max_connections=50,
+                keepalive_expiry=30.0
+            ),
+            headers={
+                "kbn-version": KIBANA_VERSION,
+                "kbn-xsrf": "kibana",
+                "x-elastic-internal-origin": "Kibana",
+                # 所有请求体均为 JSON（登录与 proxy），无需逐请求传入 headers
+                "Content-Type": "application/json"
+            }
+        )
+        self._load_cached_session()
+    
+    def _load_cached_session(self) -> None:
+        """从磁盘缓存恢复未过期的 sid cookie，避免每次启动都重新登录"""
+        try:
+            cached = orjson.loads(SESSION_CACHE_FILE.read_bytes())
+        except (OSError, orjson.JSONDecodeError):
+            return
+        
+        if not isinstance(cached, dict):
+            return
+        if cached.get("url") != KIBANA_URL or cached.get("username") != self.username:
+            return
+        
+        sid = cached.get("sid")
+        expires = cached.get("expires")
+        if not isinstance(sid, str) or not sid or not isinstance(expires, (int, float)):
+            return
+        
+        remaining = expires - time.time()
+        if remaining <= 0:
+            return
+        
+        self.sid_cookie = sid
+        self.session_expires_at = time.monotonic() + remaining
+        # 按真实登录响应的方式写入 cookie jar，保证 localhost 等单标签主机也能正确携带
+        self.client.cookies.extract_cookies(httpx.Response(
+            200,
+            headers={"set-cookie": f"sid={sid}; Path=/"},
+            request=httpx.Request("GET", KIBANA_URL)
+        ))
+    
+    def _save_cached_session(self) -> None:
+        """将 sid cookie 及其过期时间（墙钟时间）写入磁盘缓存，权限 0600"""
+        data = orjson.dumps({
+            "url": KIBANA_URL,
+            "username": self.username,
+            "sid": self.sid_cookie,
+            "expires": time.time() + (self.session_expires_at - time.monotonic())
+        })
+        try:
+            SESSION_CACHE_FILE.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            fd = os.open(SESSION_CACHE_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            # O_CREAT 的权限仅对新文件生效，已存在的文件需显式收紧
+            os.fchmod(fd, 0o600)
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+        except OSError:
+            # 缓存仅用于加速启动，写入失败不影响登录
+            pass
+    
+    @staticmethod
+    def _clear_cached_session() -> None:
+        """删除磁盘上的会话缓存"""
+        try:
+            SESSION_CACHE_FILE.unlink()
+        except OSError:
+            pass
     
     async def ensure_authenticated(self) -> None:
         """确保当前会话已认证，如果未认证或过期则重新登录"""
         if self._is_session_valid():
             return
         
-        await self.login()
+        async with self._login_lock:
+            # 等待锁期间其他请求可能已完成登录
+            if self._is_session_valid():
+                return
+            await self.login()
     
     def _is_session_valid(self) -> bool:
         """检查会话是否有效"""
-        if not self.sid_cookie or not self.session_created_at:
-            return False
-        
-        # 检查是否超时
-        if datetime.now() - self.session_created_at > SESSION_TIMEOUT:
-            return False
-        
-        return True
+        return self.sid_cookie is not None and time.monotonic() < self.session_expires_at
     
     async def login(self) -> None:
         """登录 Kibana 获取 sid cookie"""
-        login_url = f"{KIBANA_URL}/internal/security/login"
-        
-        payload = {
-            "providerType": "basic",
-            "providerName": "cloud-basic",
-            "currentURL": f"{KIBANA_URL}/login?msg=LOGGED_OUT",
-            "params": {
-                "username": self.username,
-                "password": self.password
-            }
-        }
-        
-        headers = {
-            "Content-Type": "application/json",
-            "kbn-version": KIBANA_VERSION,
-            "kbn-xsrf": "kibana"
-        }
+        # 清除旧 sid（包括从磁盘缓存恢复的），避免 cookie jar 中出现多个 path/domain 不同的 sid
+        self.client.cookies.delete("sid")
+        self.sid_cookie = None
         
         try:
-            print(f"DEBUG: Attempting login to {login_url} with user {self.username}", file=sys.stderr)
-            response = await self.client.post(
-                login_url,
-                json=payload,
-                headers=headers
-            )
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Attempting login to %s with user %s", self._login_url, self.username)
+            response = await self._post_with_retry(self._login_url, self._login_body)
             
             if response.status_code == 200:
-                # 提取 sid cookie
-                set_cookie = response.headers.get("set-cookie", "")
-                if "sid=" in set_cookie:
-                    # 提取 sid 值
-                    sid_start = set_cookie.find("sid=") + 4
-                    sid_end = set_cookie.find(";", sid_start)
-                    self.sid_cookie = set_cookie[sid_start:sid_end]
-                    self.session_created_at = datetime.now()
-                else:
+                # 只认本次登录响应下发的 sid；httpx 同时会将其写入客户端 cookie jar，后续请求自动携带
+                sid = response.cookies.get("sid")
+                if not sid:
                     raise Exception("登录成功但未获取到 sid cookie")
+                self.sid_cookie = sid
+                self.session_expires_at = time.monotonic() + SESSION_TIMEOUT.total_seconds()
+                self._save_cached_session()
             else:
                 raise Exception(f"登录失败: {response.status_code} - {response.text}")
         
         except Exception as e:
             raise Exception(f"Kibana 登录错误: {str(e)}")
     
-    async def request(self, path: str, query: dict) -> dict:
+    async def _post_with_retry(self, url: str, content: bytes) -> httpx.Response:
+        """发送 POST 请求，对瞬时网络错误和 5xx 网关错误按指数退避重试"""
+        for attempt in range(MAX_RETRIES):
+            if attempt > 0:
+                await asyncio.sleep(_backoff_delay(attempt - 1))
+            
+            is_last_attempt = attempt == MAX_RETRIES - 1
+            
+            try:
+                response = await self.client.post(url, content=content)
+            except RETRYABLE_EXCEPTIONS:
+                if is_last_attempt:
+                    raise
+                continue
+            
+            if response.status_code in RETRYABLE_STATUS_CODES and not is_last_attempt:
+                continue
+            
+            return response
+    
+    async def request(self, path: str, query: Union[dict, bytes]) -> dict:
         """
         发送请求到 Kibana proxy 端点
-        自动处理 401 错误并重新登录
+        query 可以是查询 dict，也可以是已序列化好的 JSON bytes
+        自动处理 401 错误并重新登录，对连接错误和 5xx 网关错误按指数退避重试
         """
         await self.ensure_authenticated()
         
-        encoded_path = quote(path, safe='')
-        url = f"{KIBANA_URL}/api/console/proxy?path={encoded_path}&method=POST"
-        
-        headers = {
-            "Cookie": f"sid={self.sid_cookie}",
-            "kbn-xsrf": "kibana",
-            "kbn-version": KIBANA_VERSION,
-            "Content-Type": "application/json",
-            "x-elastic-internal-origin": "Kibana"
-        }
+        url = _build_proxy_url(path)
+        body = query if isinstance(query, bytes) else orjson.dumps(query)
         
         try:
-            response = await self.client.post(
-                url,
-                json=query,
-                headers=headers
-            )
-            
-            # 如果遇到 401，重新登录后重试
-            if response.status_code == 401:
-                await self.login()
+            for attempt in range(MAX_RETRIES):
+                if attempt > 0:
+                    await asyncio.sleep(_backoff_delay(attempt - 1))
+                
+                is_last_attempt = attempt == MAX_RETRIES - 1
                 
-                # 更新 headers 中的 cookie
-                headers["Cookie"] = f"sid={self.sid_cookie}"
+                # 记录本次请求实际携带的 sid，用于判断 401 后是否已有其他请求完成重新登录
+                sent_sid = self.sid_cookie
+                try:
+                    response = await self.client.post(
+                        url,
+                        content=body
+                    )
+                except RETRYABLE_EXCEPTIONS:
+                    if is_last_attempt:
+                        raise
+                    continue
                 
-                # 重试请求
-                response = await self.client.post(
-                    url,
-                    json=query,
-                    headers=headers
-                )
+                # 如果遇到 401，重新登录后重试
+                if response.status_code == 401 and not is_last_attempt:
+                    async with self._login_lock:
+                        # sid 已变化说明其他请求已完成重新登录（且已写入新的缓存）
+                        if self.sid_cookie == sent_sid:
+                            self._clear_cached_session()
+                            await self.login()
+                    continue
+                
+                if response.status_code in RETRYABLE_STATUS_CODES and not is_last_attempt:
+                    continue
+                
+                break
             
             if response.status_code == 200:
-                return response.json()
+                return orjson.loads(response.content)
             else:
                 raise Exception(f"请求失败: {response.status_code} - {response.text}")
         
@@ -175,161 +305,196 @@ def get_session() -> KibanaSession:
 app = Server("kibana")
 
 
-@app.list_tools()
-async def list_tools() -> list[Tool]:
-    """列出所有可用的工具"""
-    return [
-        Tool(
-            name="kibana_search_logs",
-            description="搜索 Kibana 日志。支持自定义 Elasticsearch DSL 查询或简单的关键词搜索",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "query": {
-                        "type": "string",
-                        "description": "搜索关键词（简单搜索）或完整的 Elasticsearch DSL 查询 JSON 字符串"
-                    },
-                    "time_range": {
-                        "type": "string",
-                        "description": "时间范围，如 'now-1h', 'now-24h', 'now-7d' 等",
-                        "default": "now-1h"
-                    },
-                    "size": {
-                        "type": "integer",
-                        "description": "返回结果数量",
-                        "default": 20,
-                        "minimum": 1,
-                        "maximum": 1000
-                    },
-                    "index_pattern": {
-                        "type": "string",
-                        "description": "索引模式",
-                        "default": "logstash-*"
-                    },
-                    "fields": {
-                        "type": "array",
-                        "items": {"type": "string"},
-                        "description": "要返回的字段列表",
-                        "default": ["@timestamp", "kubernetes.container_name", "log"]
-                    }
+# 工具列表在导入时构建一次，list_tools 直接返回
+_TOOLS: list[Tool] = [
+    Tool(
+        name="kibana_search_logs",
+        description="搜索 Kibana 日志。支持自定义 Elasticsearch DSL 查询或简单的关键词搜索",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "query": {
+                    "type": "string",
+                    "description": "搜索关键词（简单搜索）或完整的 Elasticsearch DSL 查询 JSON 字符串"
                 },
-                "required": ["query"]
-            }
-        ),
-        Tool(
-            name="kibana_aggregate_logs",
-            description="聚合统计 Kibana 日志。可以按服务、时间等维度统计",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "aggregation_type": {
-                        "type": "string",
-                        "enum": ["by_service", "by_time", "custom"],
-                        "description": "聚合类型: by_service(按服务统计), by_time(按时间统计), custom(自定义聚合)"
-                    },
-                    "time_range": {
-                        "type": "string",
-                        "description": "时间范围，如 'now-1h', 'now-24h' 等",
-                        "default": "now-1h"
-                    },
-                    "filter": {
-                        "type": "string",
-                        "description": "可选的过滤条件（Elasticsearch DSL JSON 字符串）"
-                    },
-                    "custom_aggregation": {
-                        "type": "string",
-                        "description": "自定义聚合查询（仅当 aggregation_type 为 'custom' 时使用）"
-                    },
-                    "index_pattern": {
-                        "type": "string",
-                        "description": "索引模式",
-                        "default": "logstash-*"
-                    }
+                "time_range": {
+                    "type": "string",
+                    "description": "时间范围，如 'now-1h', 'now-24h', 'now-7d' 等",
+                    "default": "now-1h"
                 },
-                "required": ["aggregation_type"]
-            }
-        ),
-        Tool(
-            name="kibana_get_latest_logs",
-            description="快速获取最新的日志记录",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "service": {
-                        "type": "string",
-                        "description": "服务名称（kubernetes.container_name），为空则返回所有服务"
-                    },
-                    "size": {
-                        "type": "integer",
-                        "description": "返回数量",
-                        "default": 10,
-                        "minimum": 1,
-                        "maximum": 100
-                    },
-                    "index_pattern": {
-                        "type": "string",
-                        "description": "索引模式",
-                        "default": "logstash-*"
-                    }
+                "size": {
+                    "type": "integer",
+                    "description": "返回结果数量",
+                    "default": 20,
+                    "minimum": 1,
+                    "maximum": 1000
+                },
+                "index_pattern": {
+                    "type": "string",
+                    "description": "索引模式",
+                    "default": "logstash-*"
+                },
+                "fields": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "要返回的字段列表",
+                    "default": ["@timestamp", "kubernetes.container_name", "log"]
                 }
-            }
-        ),
-        Tool(
-            name="kibana_search_errors",
-            description="搜索错误日志（包含 error、exception、fail 等关键词）",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "service": {
-                        "type": "string",
-                        "description": "服务名称（kubernetes.container_name），为空则搜索所有服务"
-                    },
-                    "severity": {
-                        "type": "string",
-                        "enum": ["error", "exception", "critical", "all"],
-                        "description": "错误严重程度",
-                        "default": "all"
-                    },
-                    "time_range": {
-                        "type": "string",
-                        "description": "时间范围",
-                        "default": "now-1h"
-                    },
-                    "size": {
-                        "type": "integer",
-                        "description": "返回数量",
-                        "default": 20,
-                        "minimum": 1,
-                        "maximum": 100
-                    },
-                    "index_pattern": {
-                        "type": "string",
-                        "description": "索引模式",
-                        "default": "logstash-*"
-                    }
+            },
+            "required": ["query"]
+        }
+    ),
+    Tool(
+        name="kibana_aggregate_logs",
+        description="聚合统计 Kibana 日志。可以按服务、时间等维度统计",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "aggregation_type": {
+                    "type": "string",
+                    "enum": ["by_service", "by_time", "custom"],
+                    "description": "聚合类型: by_service(按服务统计), by_time(按时间统计), custom(自定义聚合)"
+                },
+                "time_range": {
+                    "type": "string",
+                    "description": "时间范围，如 'now-1h', 'now-24h' 等",
+                    "default": "now-1h"
+                },
+                "filter": {
+                    "type": "string",
+                    "description": "可选的过滤条件（Elasticsearch DSL JSON 字符串）"
+                },
+                "custom_aggregation": {
+                    "type": "string",
+                    "description": "自定义聚合查询（仅当 aggregation_type 为 'custom' 时使用）"
+                },
+                "index_pattern": {
+                    "type": "string",
+                    "description": "索引模式",
+                    "default": "logstash-*"
+                }
+            },
+            "required": ["aggregation_type"]
+        }
+    ),
+    Tool(
+        name="kibana_get_latest_logs",
+        description="快速获取最新的日志记录",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "service": {
+                    "type": "string",
+                    "description": "服务名称（kubernetes.container_name），为空则返回所有服务"
+                },
+                "size": {
+                    "type": "integer",
+                    "description": "返回数量",
+                    "default": 10,
+                    "minimum": 1,
+                    "maximum": 100
+                },
+                "index_pattern": {
+                    "type": "string",
+                    "description": "索引模式",
+                    "default": "logstash-*"
                 }
             }
-        ),
-        Tool(
-            name="kibana_raw_query",
-            description="执行原始的 Elasticsearch DSL 查询（高级用户）",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "path": {
-                        "type": "string",
-                        "description": "Elasticsearch 路径，如 '/logstash-*/_search'",
-                        "default": "/logstash-*/_search"
-                    },
-                    "query": {
-                        "type": "string",
-                        "description": "完整的 Elasticsearch DSL 查询 JSON 字符串"
-                    }
+        }
+    ),
+    Tool(
+        name="kibana_search_errors",
+        description="搜索错误日志（包含 error、exception、fail 等关键词）",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "service": {
+                    "type": "string",
+                    "description": "服务名称（kubernetes.container_name），为空则搜索所有服务"
+                },
+                "severity": {
+                    "type": "string",
+                    "enum": ["error", "exception", "critical", "all"],
+                    "description": "错误严重程度",
+                    "default": "all"
                 },
-                "required": ["query"]
+                "time_range": {
+                    "type": "string",
+                    "description": "时间范围",
+                    "default": "now-1h"
+                },
+                "size": {
+                    "type": "integer",
+                    "description": "返回数量",
+                    "default": 20,
+                    "minimum": 1,
+                    "maximum": 100
+                },
+                "index_pattern": {
+                    "type": "string",
+                    "description": "索引模式",
+                    "default": "logstash-*"
+                }
             }
-        )
-    ]
+        }
+    ),
+    Tool(
+        name="kibana_raw_query",
+        description="执行原始的 Elasticsearch DSL 查询（高级用户）",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "path": {
+                    "type": "string",
+                    "description": "Elasticsearch 路径，如 '/logstash-*/_search'",
+                    "default": "/logstash-*/_search"
+                },
+                "query": {
+                    "type": "string",
+                    "description": "完整的 Elasticsearch DSL 查询 JSON 字符串"
+                }
+            },
+            "required": ["query"]
+        }
+    ),
+    Tool(
+        name="kibana_batch_search",
+        description="批量并发执行多个 Elasticsearch DSL 查询，一次调用返回所有结果",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "queries": {
+                    "type": "array",
+                    "description": f"查询列表，各查询并发执行（最多 {BATCH_MAX_QUERIES} 个）",
+                    "minItems": 1,
+                    "maxItems": BATCH_MAX_QUERIES,
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "path": {
+                                "type": "string",
+                                "description": "Elasticsearch 路径，如 '/logstash-*/_search'",
+                                "default": "/logstash-*/_search"
+                            },
+                            "query": {
+                                "type": "string",
+                                "description": "完整的 Elasticsearch DSL 查询 JSON 字符串"
+                            }
+                        },
+                        "required": ["query"]
+                    }
+                }
+            },
+            "required": ["queries"]
+        }
+    )
+]
+
+
+@app.list_tools()
+async def list_tools() -> list[Tool]:
+    """列出所有可用的工具"""
+    return _TOOLS
 
 
 @app.call_tool()
@@ -354,10 +519,31 @@ async def call_tool(name: str, arguments: Any) -> list[TextContent]:
     elif name == "kibana_raw_query":
         return await handle_raw_query(session, arguments)
     
+    elif name == "kibana_batch_search":
+        return await handle_batch_search(session, arguments)
+    
     else:
         raise ValueError(f"未知工具: {name}")
 
 
+def _looks_like_json_object(s: str) -> bool:
+    """粗略判断字符串是否为 JSON 对象，避免对普通关键词走 JSON 解析失败的异常路径"""
+    return s.lstrip().startswith("{")
+
+
+def _format_hits(hits: list[dict], snippet_len: int) -> str:
+    """将搜索命中格式化为编号列表，日志内容截断到 snippet_len 个字符"""
+    parts: list[str] = []
+    for i, hit in enumerate(hits, 1):
+        source = hit.get("_source", _EMPTY)
+        service = source.get("kubernetes", _EMPTY).get("container_name", "N/A")
+        log = source.get("log", "N/A")
+        if len(log) > snippet_len:
+            log = log[:snippet_len] + "..."
+        parts.append(f"{i}. [{source.get('@timestamp', 'N/A')}] {service}\n   {log}\n\n")
+    return "".join(parts)
+
+
 async def handle_search_logs(session: KibanaSession, args: dict) -> list[TextContent]:
     """处理日志搜索"""
     query_str = args["query"]
@@ -367,9 +553,14 @@ async def handle_search_logs(session: KibanaSession, args: dict) -> list[TextCon
     fields = args.get("fields", ["@timestamp", "kubernetes.container_name", "log"])
     
     # 尝试解析为 JSON（完整的 DSL 查询）
-    try:
-        query_dsl = json.loads(query_str)
-    except json.JSONDecodeError:
+    query_dsl = None
+    if _looks_like_json_object(query_str):
+        try:
+            query_dsl = orjson.loads(query_str)
+        except orjson.JSONDecodeError:
+            pass
+    
+    if query_dsl is None:
         # 简单关键词搜索
         query_dsl = {
             "query": {
@@ -393,25 +584,17 @@ async def handle_search_logs(session: KibanaSession, args: dict) -> list[TextCon
     if "_source" not in query_dsl:
         query_dsl["_source"] = fields
     
-    path = f"/{index_pattern}/_search"
+    path = f"/{index_pattern}/_search?{_HITS_FILTER_PATH}"
     result = await session.request(path, query_dsl)
     
     # 格式化输出
-    hits = result.get("hits", {}).get("hits", [])
-    total = result.get("hits", {}).get("total", {}).get("value", 0)
-    
-    output = f"📊 找到 {total} 条日志，显示前 {len(hits)} 条：\n\n"
+    hits_obj = result.get("hits", _EMPTY)
+    hits = hits_obj.get("hits", [])
+    total = hits_obj.get("total", _EMPTY).get("value", 0)
     
-    for i, hit in enumerate(hits, 1):
-        source = hit.get("_source", {})
-        timestamp = source.get("@timestamp", "N/A")
-        service = source.get("kubernetes", {}).get("container_name", "N/A")
-        log = source.get("log", "N/A")
-        
-        output += f"{i}. [{timestamp}] {service}\n"
-        output += f"   {log[:200]}{'...' if len(log) > 200 else ''}\n\n"
+    header = f"📊 找到 {total} 条日志，显示前 {len(hits)} 条：\n\n"
     
-    return [TextContent(type="text", text=output)]
+    return [TextContent(type="text", text=header + _format_hits(hits, 200))]
 
 
 async def handle_aggregate_logs(session: KibanaSession, args: dict) -> list[TextContent]:
@@ -427,11 +610,11 @@ async def handle_aggregate_logs(session: KibanaSession, args: dict) -> list[Text
     
     # 添加过滤条件
     filter_query = args.get("filter")
-    if filter_query:
+    if filter_query and _looks_like_json_object(filter_query):
         try:
-            filter_dsl = json.loads(filter_query)
+            filter_dsl = orjson.loads(filter_query)
             base_query = {"bool": {"must": [base_query, filter_dsl]}}
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             pass
     
     if agg_type == "by_service":
@@ -454,9 +637,10 @@ async def handle_aggregate_logs(session: KibanaSession, args: dict) -> list[Text
             "query": base_query,
             "aggs": {
                 "logs_over_time": {
-                    "date_histogram": {
+                    # 由 ES 根据时间范围自动选择间隔，桶数量不随 time_range 膨胀
+                    "auto_date_histogram": {
                         "field": "@timestamp",
-                        "fixed_interval": "5m"
+                        "buckets": 60
                     }
                 }
             }
@@ -466,18 +650,18 @@ async def handle_aggregate_logs(session: KibanaSession, args: dict) -> list[Text
         if not custom_agg:
             raise ValueError("custom 聚合类型需要提供 custom_aggregation 参数")
         try:
-            agg_dsl = json.loads(custom_agg)
+            agg_dsl = orjson.loads(custom_agg)
             query_dsl = {
                 "size": 0,
                 "query": base_query,
                 "aggs": agg_dsl
             }
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             raise ValueError(f"custom_aggregation 不是有效的 JSON: {str(e)}")
     else:
         raise ValueError(f"未知的聚合类型: {agg_type}")
     
-    path = f"/{index_pattern}/_search"
+    path = f"/{index_pattern}/_search?{_AGGS_FILTER_PATH}"
     result = await session.request(path, query_dsl)
     
     # 格式化输出
@@ -485,22 +669,33 @@ async def handle_aggregate_logs(session: KibanaSession, args: dict) -> list[Text
     
     if agg_type == "by_service":
         buckets = aggs.get("services", {}).get("buckets", [])
-        output = f"📈 服务日志统计（时间范围: {time_range}）:\n\n"
+        parts = [f"📈 服务日志统计（时间范围: {time_range}）:\n\n"]
         for bucket in buckets:
             service = bucket["key"]
             count = bucket["doc_count"]
-            output += f"  • {service}: {count:,} 条\n"
+            parts.append(f"  • {service}: {count:,} 条\n")
     elif agg_type == "by_time":
         buckets = aggs.get("logs_over_time", {}).get("buckets", [])
-        output = f"📈 时间序列日志统计（时间范围: {time_range}）:\n\n"
+        parts = [f"📈 时间序列日志统计（时间范围: {time_range}）:\n\n"]
         for bucket in buckets:
             timestamp = bucket["key_as_string"]
             count = bucket["doc_count"]
-            output += f"  • {timestamp}: {count:,} 条\n"
+            parts.append(f"  • {timestamp}: {count:,} 条\n")
     else:
-        output = f"📈 自定义聚合结果:\n\n{json.dumps(aggs, indent=2, ensure_ascii=False)}"
+        parts = [f"📈 自定义聚合结果:\n\n{orjson.dumps(aggs, option=orjson.OPT_INDENT_2).decode()}"]
     
-    return [TextContent(type="text", text=output)]
+    return [TextContent(type="text", text="".join(parts))]
+
+
+@functools.lru_cache(maxsize=32)
+def _latest_logs_body(size: int) -> bytes:
+    """不带服务过滤的最新日志查询体（按 size 缓存序列化结果）"""
+    return orjson.dumps({
+        "query": {"match_all": {}},
+        "size": size,
+        "sort": [{"@timestamp": {"order": "desc"}}],
+        "_source": ["@timestamp", "kubernetes.container_name", "log"]
+    })
 
 
 async def handle_get_latest_logs(session: KibanaSession, args: dict) -> list[TextContent]:
@@ -509,41 +704,30 @@ async def handle_get_latest_logs(session: KibanaSession, args: dict) -> list[Tex
     size = args.get("size", 10)
     index_pattern = args.get("index_pattern", "logstash-*")
     
-    query_dsl = {
-        "query": {"match_all": {}},
-        "size": size,
-        "sort": [{"@timestamp": {"order": "desc"}}],
-        "_source": ["@timestamp", "kubernetes.container_name", "log"]
-    }
-    
     # 添加服务过滤
     if service:
-        query_dsl["query"] = {
-            "match": {
-                "kubernetes.container_name": service
-            }
+        query = {
+            "query": {
+                "match": {
+                    "kubernetes.container_name": service
+                }
+            },
+            "size": size,
+            "sort": [{"@timestamp": {"order": "desc"}}],
+            "_source": ["@timestamp", "kubernetes.container_name", "log"]
         }
+    else:
+        query = _latest_logs_body(size)
     
-    path = f"/{index_pattern}/_search"
-    result = await session.request(path, query_dsl)
-    
-    hits = result.get("hits", {}).get("hits", [])
+    path = f"/{index_pattern}/_search?{_HITS_FILTER_PATH}"
+    result = await session.request(path, query)
     
-    output = f"📝 最新 {len(hits)} 条日志"
-    if service:
-        output += f"（服务: {service}）"
-    output += ":\n\n"
+    hits = result.get("hits", _EMPTY).get("hits", [])
     
-    for i, hit in enumerate(hits, 1):
-        source = hit.get("_source", {})
-        timestamp = source.get("@timestamp", "N/A")
-        svc = source.get("kubernetes", {}).get("container_name", "N/A")
-        log = source.get("log", "N/A")
-        
-        output += f"{i}. [{timestamp}] {svc}\n"
-        output += f"   {log[:200]}{'...' if len(log) > 200 else ''}\n\n"
+    service_note = f"（服务: {service}）" if service else ""
+    header = f"📝 最新 {len(hits)} 条日志{service_note}:\n\n"
     
-    return [TextContent(type="text", text=output)]
+    return [TextContent(type="text", text=header + _format_hits(hits, 200))]
 
 
 async def handle_search_errors(session: KibanaSession, args: dict) -> list[TextContent]:
@@ -554,24 +738,24 @@ async def handle_search_errors(session: KibanaSession, args: dict) -> list[TextC
     size = args.get("size", 20)
     index_pattern = args.get("index_pattern", "logstash-*")
     
-    # 构建错误关键词
+    # 构建错误关键词（log 为分词字段，match 查询会统一小写，无需列出大小写变体）
     error_keywords = {
-        "error": ["error", "Error", "ERROR"],
-        "exception": ["exception", "Exception", "EXCEPTION"],
-        "critical": ["critical", "Critical", "CRITICAL", "fatal", "Fatal", "FATAL"],
-        "all": ["error", "Error", "ERROR", "exception", "Exception", "fail", "Fail", "FAIL"]
+        "error": ["error"],
+        "exception": ["exception"],
+        "critical": ["critical", "fatal"],
+        "all": ["error", "exception", "fail"]
     }
     
     keywords = error_keywords.get(severity, error_keywords["all"])
     
-    # 构建查询
+    # 构建查询：单个 match（OR 连接关键词）
     must_clauses = [
         {
-            "bool": {
-                "should": [
-                    {"match": {"log": keyword}} for keyword in keywords
-                ],
-                "minimum_should_match": 1
+            "match": {
+                "log": {
+                    "query": " ".join(keywords),
+                    "operator": "or"
+                }
             }
         }
     ]
@@ -595,27 +779,17 @@ async def handle_search_errors(session: KibanaSession, args: dict) -> list[TextC
         "_source": ["@timestamp", "kubernetes.container_name", "log"]
     }
     
-    path = f"/{index_pattern}/_search"
+    path = f"/{index_pattern}/_search?{_HITS_FILTER_PATH}"
     result = await session.request(path, query_dsl)
     
-    hits = result.get("hits", {}).get("hits", [])
-    total = result.get("hits", {}).get("total", {}).get("value", 0)
-    
-    output = f"🚨 找到 {total} 条错误日志"
-    if service:
-        output += f"（服务: {service}）"
-    output += f"，显示前 {len(hits)} 条:\n\n"
+    hits_obj = result.get("hits", _EMPTY)
+    hits = hits_obj.get("hits", [])
+    total = hits_obj.get("total", _EMPTY).get("value", 0)
     
-    for i, hit in enumerate(hits, 1):
-        source = hit.get("_source", {})
-        timestamp = source.get("@timestamp", "N/A")
-        svc = source.get("kubernetes", {}).get("container_name", "N/A")
-        log = source.get("log", "N/A")
-        
-        output += f"{i}. [{timestamp}] {svc}\n"
-        output += f"   {log[:300]}{'...' if len(log) > 300 else ''}\n\n"
+    service_note = f"（服务: {service}）" if service else ""
+    header = f"🚨 找到 {total} 条错误日志{service_note}，显示前 {len(hits)} 条:\n\n"
     
-    return [TextContent(type="text", text=output)]
+    return [TextContent(type="text", text=header + _format_hits(hits, 300))]
 
 
 async def handle_raw_query(session: KibanaSession, args: dict) -> list[TextContent]:
@@ -624,31 +798,75 @@ async def handle_raw_query(session: KibanaSession, args: dict) -> list[TextConte
     query_str = args["query"]
     
     try:
-        query_dsl = json.loads(query_str)
-    except json.JSONDecodeError as e:
+        query_dsl = orjson.loads(query_str)
+    except orjson.JSONDecodeError as e:
         raise ValueError(f"查询不是有效的 JSON: {str(e)}")
     
     result = await session.request(path, query_dsl)
     
     # 格式化 JSON 输出
-    output = json.dumps(result, indent=2, ensure_ascii=False)
+    output = orjson.dumps(result, option=orjson.OPT_INDENT_2).decode()
     
     return [TextContent(type="text", text=output)]
 
 
+async def handle_batch_search(session: KibanaSession, args: dict) -> list[TextContent]:
+    """并发执行多个查询"""
+    queries = args["queries"]
+    if not queries:
+        raise ValueError("queries 不能为空")
+    if len(queries) > BATCH_MAX_QUERIES:
+        raise ValueError(f"queries 最多 {BATCH_MAX_QUERIES} 个，当前 {len(queries)} 个")
+    
+    requests = []
+    for i, q in enumerate(queries, 1):
+        path = q.get("path", "/logstash-*/_search")
+        try:
+            query_dsl = orjson.loads(q["query"])
+        except orjson.JSONDecodeError as e:
+            raise ValueError(f"第 {i} 个查询不是有效的 JSON: {str(e)}")
+        requests.append((path, query_dsl))
+    
+    # 所有请求共享同一个 HTTP/2 连接并发发送
+    results = await asyncio.gather(
+        *[session.request(path, query_dsl) for path, query_dsl in requests],
+        return_exceptions=True
+    )
+    
+    parts: list[str] = [f"📦 批量查询完成，共 {len(results)} 个查询:\n\n"]
+    for i, ((path, _), result) in enumerate(zip(requests, results), 1):
+        parts.append(f"### 查询 {i}: {path}\n")
+        if isinstance(result, Exception):
+            parts.append(f"❌ {str(result)}\n\n")
+        else:
+            parts.append(f"{orjson.dumps(result, option=orjson.OPT_INDENT_2).decode()}\n\n")
+    
+    return [TextContent(type="text", text="".join(parts))]
+
+
 async def main():
     """启动 MCP server"""
     from mcp.server.stdio import stdio_server
     
-    async with stdio_server() as (read_stream, write_stream):
-        await app.run(
-            read_stream,
-            write_stream,
-            app.create_initialization_options()
-        )
+    try:
+        async with stdio_server() as (read_stream, write_stream):
+            await app.run(
+                read_stream,
+                write_stream,
+                app.create_initialization_options()
+            )
+    finally:
+        # 退出前关闭 HTTP 客户端，释放连接池
+        if _session is not None:
+            await _session.close()
 
 def run():
     """同步入口点，用于 console_scripts"""
+    # 日志输出到 stderr（stdout 用于 MCP 协议通信）
+    # 设置 DEBUG 环境变量只开启本模块的详细日志；第三方库（如 hpack）的 DEBUG 日志会输出 cookie
+    logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+    if os.getenv("DEBUG"):
+        logger.setLevel(logging.DEBUG)
     asyncio.run(main())
 
 if __name__ == "__main__":